@@ -3,6 +3,7 @@ Main module for the Telegram bot.
 Handles command processing and bot interactions.
 """
 
+import datetime
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -27,6 +28,39 @@ logger = logging.getLogger(__name__)
 # Initialize database
 db = Database(config.DATABASE_FILE)
 
+# Static messages and keyboards, built once at import time
+PURCHASE_DATE_FORMAT = '%Y-%m-%d'
+
+HELP_TEXT = (
+    "🎬 *Video Sales Bot Commands* 🎬\n\n"
+    "*User Commands:*\n"
+    "/start - Start the bot\n"
+    "/help - Show this help message\n"
+    "/list - List all available videos\n"
+    "/view [video_id] - View details of a specific video\n"
+    "/buy [video_id] - Purchase a specific video\n"
+    "/mypurchases - View your purchased videos\n\n"
+    "*Admin Commands:*\n"
+    "/admin - Access admin panel\n"
+    "/addvideo - Add a new video\n"
+    "/removevideo [video_id] - Remove a video\n"
+    "/updatevideo [video_id] - Update video details\n"
+    "/sales - View sales statistics\n"
+    "/broadcast - Send a message to all users"
+)
+
+ADMIN_PANEL_TEXT = (
+    "🔐 *Admin Panel* 🔐\n\n"
+    "Select an option:"
+)
+
+ADMIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Add Video", callback_data="admin_add_video")],
+    [InlineKeyboardButton("View All Videos", callback_data="admin_view_videos")],
+    [InlineKeyboardButton("Sales Statistics", callback_data="admin_sales")],
+    [InlineKeyboardButton("Broadcast Message", callback_data="admin_broadcast")]
+])
+
 # Command handlers
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message when the command /start is issued."""
@@ -41,25 +75,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
-    help_text = (
-        "🎬 *Video Sales Bot Commands* 🎬\n\n"
-        "*User Commands:*\n"
-        "/start - Start the bot\n"
-        "/help - Show this help message\n"
-        "/list - List all available videos\n"
-        "/view [video_id] - View details of a specific video\n"
-        "/buy [video_id] - Purchase a specific video\n"
-        "/mypurchases - View your purchased videos\n\n"
-        "*Admin Commands:*\n"
-        "/admin - Access admin panel\n"
-        "/addvideo - Add a new video\n"
-        "/removevideo [video_id] - Remove a video\n"
-        "/updatevideo [video_id] - Update video details\n"
-        "/sales - View sales statistics\n"
-        "/broadcast - Send a message to all users"
-    )
-    
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
 
 async def list_videos_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """List all available videos."""
@@ -69,16 +85,16 @@ async def list_videos_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("No videos available at the moment.")
         return
     
-    message = "🎬 *Available Videos* 🎬\n\n"
+    parts = ["🎬 *Available Videos* 🎬\n\n"]
     
     for video_id, video in videos.items():
-        message += f"*{video['title']}*\n"
-        message += f"ID: `{video_id}`\n"
-        message += f"Price: {video['price']} Stars\n"
-        message += f"Duration: {video.get('duration', 'N/A')}\n\n"
-        message += f"Use /view {video_id} for more details\n\n"
+        parts.append(f"*{video['title']}*\n")
+        parts.append(f"ID: `{video_id}`\n")
+        parts.append(f"Price: {video['price']} Stars\n")
+        parts.append(f"Duration: {video.get('duration', 'N/A')}\n\n")
+        parts.append(f"Use /view {video_id} for more details\n\n")
     
-    await update.message.reply_text(message, parse_mode='Markdown')
+    await update.message.reply_text("".join(parts), parse_mode='Markdown')
 
 async def view_video_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """View details of a specific video."""
@@ -105,14 +121,7 @@ async def view_video_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Implementation depends on how previews are stored
         pass
     
-    message = f"🎬 *{video['title']}* 🎬\n\n"
-    message += f"*Description:* {video['description']}\n\n"
-    message += f"*Price:* {video['price']} Stars\n"
-    message += f"*Duration:* {video.get('duration', 'N/A')}\n"
-    if "category" in video:
-        message += f"*Category:* {video['category']}\n"
-    if "tags" in video and video["tags"]:
-        message += f"*Tags:* {', '.join(video['tags'])}\n"
+    message = db.render_video_details(video_id)
     
     await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
 
@@ -163,144 +172,160 @@ async def process_buy_request(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def my_purchases_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show user's purchased videos."""
     user_id = update.effective_user.id
-    purchases = db.get_user_purchases(user_id)
+    purchases = db.get_purchases_with_videos(user_id)
     
     if not purchases:
         await update.message.reply_text("You haven't purchased any videos yet.")
         return
     
-    message = "🎬 *Your Purchased Videos* 🎬\n\n"
+    parts = ["🎬 *Your Purchased Videos* 🎬\n\n"]
+    keyboard = []
     
     for purchase in purchases:
         video_id = purchase["video_id"]
-        video = db.get_video(video_id)
+        video = purchase["video"]
         
         if video:
-            import datetime
-            purchase_date = datetime.datetime.fromtimestamp(purchase["purchase_date"]).strftime('%Y-%m-%d')
+            purchase_date = datetime.datetime.fromtimestamp(purchase["purchase_date"]).strftime(PURCHASE_DATE_FORMAT)
             
-            message += f"*{video['title']}*\n"
-            message += f"Purchased on: {purchase_date}\n"
-            message += f"Price paid: {purchase['price_paid']} Stars\n\n"
+            parts.append(f"*{video['title']}*\n")
+            parts.append(f"Purchased on: {purchase_date}\n")
+            parts.append(f"Price paid: {purchase['price_paid']} Stars\n\n")
             
             # Add button to view this video
-            keyboard = [
-                [InlineKeyboardButton(f"Watch {video['title']}", callback_data=f"watch_{video_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            keyboard.append([InlineKeyboardButton(f"Watch {video['title']}", callback_data=f"watch_{video_id}")])
     
-    await update.message.reply_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text("".join(parts), parse_mode='Markdown', reply_markup=reply_markup)
 
 # Admin commands
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Access admin panel."""
     user_id = update.effective_user.id
     
-    if not db.is_admin(user_id) and user_id not in config.ADMIN_USER_IDS:
+    if not db.is_admin(user_id):
         await update.message.reply_text("You don't have permission to access admin features.")
         return
     
-    # If user is not in database as admin but is in config, add them
-    if not db.is_admin(user_id) and user_id in config.ADMIN_USER_IDS:
+    # If a config admin has no user record yet, add them as admin
+    if db.get_user(user_id) is None:
         user = update.effective_user
         db.add_user(user_id, user.username or "", is_admin=True)
     
-    keyboard = [
-        [InlineKeyboardButton("Add Video", callback_data="admin_add_video")],
-        [InlineKeyboardButton("View All Videos", callback_data="admin_view_videos")],
-        [InlineKeyboardButton("Sales Statistics", callback_data="admin_sales")],
-        [InlineKeyboardButton("Broadcast Message", callback_data="admin_broadcast")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
-        "🔐 *Admin Panel* 🔐\n\n"
-        "Select an option:",
-        reply_markup=reply_markup,
+        ADMIN_PANEL_TEXT,
+        reply_markup=ADMIN_KEYBOARD,
         parse_mode='Markdown'
     )
 
-# Callback query handler
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle button callbacks."""
+# Callback query handlers, each receiving the callback data after its prefix
+async def _on_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, rest: str) -> None:
+    """Handle buy_<video_id> buttons."""
+    await process_buy_request(update, context, rest)
+
+async def _on_confirm_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, rest: str) -> None:
+    """Handle confirm_buy_<video_id> buttons."""
     query = update.callback_query
-    await query.answer()
-    
-    data = query.data
-    
-    if data.startswith("buy_"):
-        video_id = data.split("_")[1]
-        await process_buy_request(update, context, video_id)
-    
-    elif data.startswith("confirm_buy_"):
-        video_id = data.split("_")[2]
-        video = db.get_video(video_id)
-        
-        if video:
-            user_id = update.effective_user.id
-            
-            # Simulate successful payment
-            success = db.add_purchase(user_id, video_id, video["price"])
-            
-            if success:
-                # Here we would actually send the video
-                await query.edit_message_text(
-                    f"✅ Payment successful! You've purchased '{video['title']}'.\n\n"
-                    f"Use /mypurchases to access your videos."
-                )
-            else:
-                await query.edit_message_text("❌ Error processing your purchase. Please try again.")
-    
-    elif data == "cancel_buy":
-        await query.edit_message_text("Purchase cancelled.")
-    
-    elif data == "view_purchases":
-        await my_purchases_command(update, context)
+    action, _, video_id = rest.partition("_")
+    if action != "buy":
+        return
+    video = db.get_video(video_id)
     
-    elif data.startswith("watch_"):
-        video_id = data.split("_")[1]
-        video = db.get_video(video_id)
+    if video:
         user_id = update.effective_user.id
         
-        if video and db.has_purchased(user_id, video_id):
-            # Here we would send the actual video file
-            await query.message.reply_text(f"Here's your video: {video['title']}")
-            # In a real implementation, we would use context.bot.send_video with the file_id
-    
-    # Admin callbacks
-    elif data.startswith("admin_") and (db.is_admin(update.effective_user.id) or update.effective_user.id in config.ADMIN_USER_IDS):
-        if data == "admin_add_video":
-            context.user_data["admin_state"] = "waiting_for_video_title"
-            await query.edit_message_text("Please send the title for the new video:")
+        # Simulate successful payment
+        success = db.add_purchase(user_id, video_id, video["price"])
         
-        elif data == "admin_view_videos":
-            videos = db.get_all_videos()
-            if not videos:
-                await query.edit_message_text("No videos in the database.")
-                return
-            
-            message = "🎬 *All Videos* 🎬\n\n"
-            for video_id, video in videos.items():
-                message += f"*{video['title']}*\n"
-                message += f"ID: `{video_id}`\n"
-                message += f"Price: {video['price']} Stars\n\n"
-            
-            await query.edit_message_text(message, parse_mode='Markdown')
+        if success:
+            # Here we would actually send the video
+            await query.edit_message_text(
+                f"✅ Payment successful! You've purchased '{video['title']}'.\n\n"
+                f"Use /mypurchases to access your videos."
+            )
+        else:
+            await query.edit_message_text("❌ Error processing your purchase. Please try again.")
+
+async def _on_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, rest: str) -> None:
+    """Handle the cancel_buy button."""
+    if rest == "buy":
+        await update.callback_query.edit_message_text("Purchase cancelled.")
+
+async def _on_view_purchases(update: Update, context: ContextTypes.DEFAULT_TYPE, rest: str) -> None:
+    """Handle the view_purchases button."""
+    if rest == "purchases":
+        await my_purchases_command(update, context)
+
+async def _on_watch(update: Update, context: ContextTypes.DEFAULT_TYPE, rest: str) -> None:
+    """Handle watch_<video_id> buttons."""
+    query = update.callback_query
+    video_id = rest
+    video = db.get_video(video_id)
+    user_id = update.effective_user.id
+    
+    if video and db.has_purchased(user_id, video_id):
+        # Here we would send the actual video file
+        await query.message.reply_text(f"Here's your video: {video['title']}")
+        # In a real implementation, we would use context.bot.send_video with the file_id
+
+async def _on_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, rest: str) -> None:
+    """Handle admin_<action> buttons for admins."""
+    if not db.is_admin(update.effective_user.id):
+        return
+    query = update.callback_query
+    
+    if rest == "add_video":
+        context.user_data["admin_state"] = "waiting_for_video_title"
+        await query.edit_message_text("Please send the title for the new video:")
+    
+    elif rest == "view_videos":
+        videos = db.get_all_videos()
+        if not videos:
+            await query.edit_message_text("No videos in the database.")
+            return
         
-        elif data == "admin_sales":
-            # Implement sales statistics
-            await query.edit_message_text("Sales statistics feature coming soon.")
+        parts = ["🎬 *All Videos* 🎬\n\n"]
+        for video_id, video in videos.items():
+            parts.append(f"*{video['title']}*\n")
+            parts.append(f"ID: `{video_id}`\n")
+            parts.append(f"Price: {video['price']} Stars\n\n")
         
-        elif data == "admin_broadcast":
-            context.user_data["admin_state"] = "waiting_for_broadcast"
-            await query.edit_message_text("Please send the message you want to broadcast to all users:")
+        await query.edit_message_text("".join(parts), parse_mode='Markdown')
+    
+    elif rest == "sales":
+        # Implement sales statistics
+        await query.edit_message_text("Sales statistics feature coming soon.")
+    
+    elif rest == "broadcast":
+        context.user_data["admin_state"] = "waiting_for_broadcast"
+        await query.edit_message_text("Please send the message you want to broadcast to all users:")
+
+# Callback handlers keyed by the callback data's first "_"-separated token
+CALLBACK_HANDLERS = {
+    "buy": _on_buy,
+    "confirm": _on_confirm_buy,
+    "cancel": _on_cancel,
+    "watch": _on_watch,
+    "view": _on_view_purchases,
+    "admin": _on_admin,
+}
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle button callbacks."""
+    query = update.callback_query
+    await query.answer()
+    
+    prefix, _, rest = query.data.partition("_")
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if handler:
+        await handler(update, context, rest)
 
 # Message handler for admin operations
 async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle messages for admin operations like adding videos."""
     user_id = update.effective_user.id
     
-    if not db.is_admin(user_id) and user_id not in config.ADMIN_USER_IDS:
+    if not db.is_admin(user_id):
         return
     
     admin_state = context.user_data.get("admin_state", None)
@@ -367,16 +392,25 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 def main() -> None:
     """Start the bot."""
-    # Create the Application
-    application = Application.builder().token(config.BOT_TOKEN).build()
-    
-    # Get bot info and update config
-    async def update_bot_info(application):
-        bot = application.bot
-        bot_info = await bot.get_me()
+    # Get bot info and update config once the application is initialized
+    async def update_bot_info(application: Application) -> None:
+        bot_info = await application.bot.get_me()
         config.BOT_USERNAME = bot_info.username
         logger.info(f"Bot started as @{config.BOT_USERNAME}")
     
+    # Let a background compaction finish before db.close() writes the final snapshot
+    async def wait_for_database(application: Application) -> None:
+        await db.wait_for_compaction()
+    
+    # Create the Application
+    application = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .post_init(update_bot_info)
+        .post_shutdown(wait_for_database)
+        .build()
+    )
+    
     # Add command handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
@@ -397,7 +431,9 @@ def main() -> None:
     
     # Start the Bot
     application.run_polling(allowed_updates=Update.ALL_TYPES)
-    application.job_queue.run_once(update_bot_info, 0)
+    
+    # Fold the journal back into the snapshot on shutdown
+    db.close()
 
 if __name__ == '__main__':
     main()
@@ -5,7 +5,7 @@ Contains configuration settings and loads sensitive data from environment variab
 
 import os
 import dotenv
-from typing import List
+from typing import FrozenSet
 
 # Load environment variables from .env file
 dotenv.load_dotenv()
@@ -15,16 +15,27 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 
 # Admin user IDs loaded from environment variable
 ADMIN_USER_IDS_STR = os.getenv("ADMIN_USER_IDS", "")
-ADMIN_USER_IDS: List[int] = []
+ADMIN_USER_IDS: FrozenSet[int] = frozenset()
 if ADMIN_USER_IDS_STR:
     try:
-        ADMIN_USER_IDS = [int(user_id.strip()) for user_id in ADMIN_USER_IDS_STR.split(",")]
+        ADMIN_USER_IDS = frozenset(int(user_id.strip()) for user_id in ADMIN_USER_IDS_STR.split(",") if user_id.strip())
     except ValueError:
         print("Warning: Invalid format for ADMIN_USER_IDS in .env file")
 
 # Database configuration
 DATABASE_FILE = "bot_database.json"
 
+# Database journal tuning, overridable from the environment
+# DB_FLUSH_DELAY: seconds to batch journal writes before one disk sync (0 syncs on the next loop turn)
+# DB_COMPACT_THRESHOLD: journal size in bytes after which it is folded into the snapshot
+DB_FLUSH_DELAY = 0.5
+DB_COMPACT_THRESHOLD = 1024 * 1024
+try:
+    DB_FLUSH_DELAY = float(os.getenv("DB_FLUSH_DELAY", DB_FLUSH_DELAY))
+    DB_COMPACT_THRESHOLD = int(os.getenv("DB_COMPACT_THRESHOLD", DB_COMPACT_THRESHOLD))
+except ValueError:
+    print("Warning: Invalid format for DB_FLUSH_DELAY or DB_COMPACT_THRESHOLD in .env file")
+
 # Payment configuration
 PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN", "")
 
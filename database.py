@@ -3,35 +3,259 @@ Database module for the Telegram bot.
 Handles storage and retrieval of videos and user data.
 """
 
-import json
+import asyncio
 import os
-from typing import Dict, List, Any, Optional
+import time
+import orjson
+from typing import Dict, Iterator, List, Any, Optional, Tuple
+import config
+
+# Seconds to wait before flushing journal writes, so bursts share one disk sync
+JOURNAL_FLUSH_DELAY = config.DB_FLUSH_DELAY
+
+# Journal size in bytes after which it is folded back into the snapshot
+JOURNAL_COMPACT_THRESHOLD = config.DB_COMPACT_THRESHOLD
 
 class Database:
+    """JSON snapshot plus append-only journal, with all lookups served from memory.
+    
+    Mutations append one line to the journal, lookups by video ID, user ID and
+    (user ID, video ID) are dict/set lookups, and the journal is folded back into
+    the snapshot once it grows past JOURNAL_COMPACT_THRESHOLD or on close().
+    """
+    
     def __init__(self, database_file: str):
         self.database_file = database_file
+        self.journal_file = database_file + ".wal"
         self.data = {
-            "videos": {},
-            "users": {}
+            "videos": {}
         }
+        # Users are kept keyed by int in memory and only stringified at the JSON boundary
+        self.users: Dict[int, Dict[str, Any]] = {}
+        # In-progress admin flows, keyed by user ID like users
+        self.admin_states: Dict[int, Dict[str, Any]] = {}
+        self._dirty = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._compact_task: Optional[asyncio.Task] = None
+        self._fsync_future: Optional[asyncio.Future] = None
+        self._compacting = False
+        self._list_message_cache: Optional[str] = None
+        # Bumped on every catalog change so callers can tell when their own renders are stale
+        self.catalog_version = 0
+        # catalog_version at each video's last add or update, for callers caching per-video renders
+        self._video_versions: Dict[str, int] = {}
+        self._details_message_cache: Dict[str, str] = {}
         self.load_database()
+        self._journal = open(self.journal_file, 'ab')
     
     def load_database(self) -> None:
-        """Load database from file if it exists."""
+        """Load the snapshot from file if it exists, then replay the journal."""
         if os.path.exists(self.database_file):
             try:
-                with open(self.database_file, 'r') as f:
-                    self.data = json.load(f)
-            except json.JSONDecodeError:
+                with open(self.database_file, 'rb') as f:
+                    self.data = orjson.loads(f.read())
+            except orjson.JSONDecodeError:
                 print("Error loading database, creating new one")
                 self.save_database()
         else:
             self.save_database()
+        self.users = {int(user_key): user for user_key, user in self.data.pop("users", {}).items()}
+        self.admin_states = {int(user_key): entry for user_key, entry in self.data.pop("admin_states", {}).items()}
+        
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'rb') as f:
+                lines = f.readlines()
+            valid_size = 0
+            for line_number, line in enumerate(lines, 1):
+                try:
+                    delta = orjson.loads(line) if line.strip() else None
+                except orjson.JSONDecodeError:
+                    if line_number < len(lines):
+                        # Entries after this one are intact, so don't drop them by truncating here
+                        raise RuntimeError(
+                            f"Database journal {self.journal_file} is corrupt at line {line_number}; "
+                            "refusing to load it"
+                        )
+                    # A torn write can only affect the last entry; drop it so new entries start on a fresh line
+                    print("Ignoring incomplete entry at end of database journal")
+                    os.truncate(self.journal_file, valid_size)
+                    break
+                if delta is not None:
+                    self._apply(delta)
+                valid_size += len(line)
+            else:
+                # A complete last entry can still be missing its newline; end it so the next append isn't joined to it
+                if lines and not lines[-1].endswith(b"\n"):
+                    with open(self.journal_file, 'ab') as f:
+                        f.write(b"\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+        
+        self._build_indexes()
+    
+    def _build_indexes(self) -> None:
+        """Build in-memory lookup indexes from the loaded data."""
+        self._purchased_index: Dict[int, set] = {}
+        for user_id, user in self.users.items():
+            self._purchased_index[user_id] = {p["video_id"] for p in user.get("purchases", [])}
+        self._admin_ids = {user_id for user_id, user in self.users.items() if user.get("is_admin")} | config.ADMIN_USER_IDS
+        self._next_video_id = self.data.get("next_video_id") or self._compute_next_video_id()
+    
+    def _compute_next_video_id(self) -> int:
+        """Find the next free video ID number by scanning existing IDs."""
+        highest_id = 0
+        for existing_id in self.data["videos"].keys():
+            if existing_id.startswith('video_'):
+                try:
+                    id_num = int(existing_id.split('_')[1])
+                    highest_id = max(highest_id, id_num)
+                except (ValueError, IndexError):
+                    pass
+        return highest_id + 1
+    
+    def _encode_snapshot(self) -> bytes:
+        """Serialize the full database as compact JSON."""
+        snapshot = {
+            **self.data,
+            "users": {str(user_id): user for user_id, user in self.users.items()},
+            "admin_states": {str(user_id): entry for user_id, entry in self.admin_states.items()}
+        }
+        return orjson.dumps(snapshot)
+    
+    def _write_snapshot(self, encoded: bytes) -> None:
+        """Atomically replace the database file with an encoded snapshot."""
+        tmp_file = self.database_file + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(encoded)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.database_file)
     
     def save_database(self) -> None:
-        """Save database to file."""
-        with open(self.database_file, 'w') as f:
-            json.dump(self.data, f, indent=4)
+        """Atomically write a full snapshot of the database to file."""
+        self._write_snapshot(self._encode_snapshot())
+    
+    def compact(self) -> None:
+        """Fold the journal into a fresh snapshot and truncate it."""
+        self.save_database()
+        self._journal.flush()
+        self._journal.seek(0)
+        self._journal.truncate()
+        self._dirty = False
+    
+    async def asave(self) -> None:
+        """Compact the database, writing the snapshot from a worker thread."""
+        if self._compacting:
+            return
+        self._compacting = True
+        try:
+            # Let an in-flight journal sync finish before the journal file is swapped out from under it
+            if self._fsync_future is not None:
+                await asyncio.wait([self._fsync_future])
+            
+            # Encode on the event loop so the data can't change mid-serialization
+            self._journal.flush()
+            compacted_size = self._journal.tell()
+            encoded = self._encode_snapshot()
+            await asyncio.to_thread(self._write_snapshot, encoded)
+            
+            # Keep only the entries appended while the snapshot was being written. They aren't
+            # in the snapshot, so swap in a synced copy rather than rewriting the journal in place.
+            # No await until the swap, so nothing can be appended to the old journal meanwhile.
+            self._journal.flush()
+            with open(self.journal_file, 'rb') as f:
+                f.seek(compacted_size)
+                remainder = f.read()
+            tmp_file = self.journal_file + ".tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(remainder)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.journal_file)
+            self._journal.close()
+            self._journal = open(self.journal_file, 'ab')
+        finally:
+            self._compacting = False
+    
+    async def wait_for_compaction(self) -> None:
+        """Wait for a background compaction to finish, so close() can't race its snapshot write."""
+        if self._compact_task is not None:
+            await asyncio.wait([self._compact_task])
+            self._compact_task = None
+    
+    def close(self) -> None:
+        """Compact the database and close the journal.
+        
+        In an event loop, await wait_for_compaction() first.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.compact()
+        self._journal.close()
+    
+    def _apply(self, delta: Dict[str, Any]) -> None:
+        """Apply a single journal entry to the in-memory data."""
+        op = delta["op"]
+        if op == "set_video":
+            self.data["videos"][delta["id"]] = delta["data"]
+            if "next_id" in delta:
+                self.data["next_video_id"] = delta["next_id"]
+        elif op == "remove_video":
+            self.data["videos"].pop(delta["id"], None)
+        elif op == "set_user":
+            self.users[delta["id"]] = delta["data"]
+        elif op == "add_purchase":
+            user = self.users.get(delta["id"])
+            # Skip entries already folded into the snapshot by an interrupted compaction
+            if user is not None and delta["data"] not in user["purchases"]:
+                user["purchases"].append(delta["data"])
+        elif op == "set_admin_state":
+            self.admin_states[delta["id"]] = delta["data"]
+        elif op == "clear_admin_state":
+            self.admin_states.pop(delta["id"], None)
+    
+    def _append_journal(self, delta: Dict[str, Any]) -> None:
+        """Append a single-line delta to the journal instead of rewriting the snapshot."""
+        self._journal.write(orjson.dumps(delta) + b"\n")
+        # Hand the entry to the OS right away so a process crash can't lose it; only the fsync is debounced
+        self._journal.flush()
+        self._mark_dirty()
+    
+    def _mark_dirty(self) -> None:
+        """Schedule a debounced journal sync, or sync now outside an event loop."""
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._flush()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(JOURNAL_FLUSH_DELAY, self._flush)
+    
+    def _flush(self) -> None:
+        """Sync journal entries written since the last flush to disk."""
+        self._flush_handle = None
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._journal.flush()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if self._journal.tell() >= JOURNAL_COMPACT_THRESHOLD:
+                self.compact()
+            else:
+                os.fsync(self._journal.fileno())
+            return
+        if self._compacting:
+            # asave syncs the journal it swaps in, and this file descriptor is about to be closed
+            return
+        if self._journal.tell() >= JOURNAL_COMPACT_THRESHOLD:
+            self._compact_task = loop.create_task(self.asave())
+            return
+        # Keep the disk sync off the event loop thread
+        self._fsync_future = loop.run_in_executor(None, os.fsync, self._journal.fileno())
     
     # Video methods
     def add_video(self, video_data: Dict[str, Any]) -> str:
@@ -51,21 +275,28 @@ class Database:
         except (ValueError, TypeError):
             raise ValueError("Price must be a valid number")
         
-        # Find the highest existing video ID number and increment by 1
-        highest_id = 0
-        for existing_id in self.data['videos'].keys():
-            if existing_id.startswith('video_'):
-                try:
-                    id_num = int(existing_id.split('_')[1])
-                    highest_id = max(highest_id, id_num)
-                except (ValueError, IndexError):
-                    pass
-        
-        # Generate a new unique ID that won't be reused even after deletions
-        video_id = video_data.get("id", f"video_{highest_id + 1}")
+        # Generate a new unique ID from a persisted counter so it won't be reused even after deletions
+        video_id = video_data.get("id")
+        if video_id is None:
+            video_id = f"video_{self._next_video_id}"
+            self._next_video_id += 1
+            self.data["next_video_id"] = self._next_video_id
+        elif video_id.startswith('video_'):
+            # Move the counter past an explicit ID so a later generated one can't collide with it
+            try:
+                id_num = int(video_id.split('_')[1])
+            except (ValueError, IndexError):
+                id_num = 0
+            if id_num >= self._next_video_id:
+                self._next_video_id = id_num + 1
+                self.data["next_video_id"] = self._next_video_id
         video_data["id"] = video_id
         self.data["videos"][video_id] = video_data
-        self.save_database()
+        self._list_message_cache = None
+        self._details_message_cache.pop(video_id, None)
+        self.catalog_version += 1
+        self._video_versions[video_id] = self.catalog_version
+        self._append_journal({"op": "set_video", "id": video_id, "data": video_data, "next_id": self._next_video_id})
         return video_id
     
     def get_video(self, video_id: str) -> Optional[Dict[str, Any]]:
@@ -76,12 +307,20 @@ class Database:
         """Get all videos."""
         return self.data["videos"]
     
+    def video_version(self, video_id: str) -> int:
+        """Get a number that changes whenever the video is added, updated or removed."""
+        return self._video_versions.get(video_id, 0)
+    
     def update_video(self, video_id: str, video_data: Dict[str, Any]) -> bool:
         """Update video data."""
         if video_id in self.data["videos"]:
             video_data["id"] = video_id  # Ensure ID remains the same
             self.data["videos"][video_id] = video_data
-            self.save_database()
+            self._list_message_cache = None
+            self.catalog_version += 1
+            self._video_versions[video_id] = self.catalog_version
+            self._details_message_cache.pop(video_id, None)
+            self._append_journal({"op": "set_video", "id": video_id, "data": video_data})
             return True
         return False
     
@@ -89,43 +328,85 @@ class Database:
         """Remove video by ID."""
         if video_id in self.data["videos"]:
             del self.data["videos"][video_id]
-            self.save_database()
+            self._list_message_cache = None
+            self.catalog_version += 1
+            self._video_versions.pop(video_id, None)
+            self._details_message_cache.pop(video_id, None)
+            self._append_journal({"op": "remove_video", "id": video_id})
             return True
         return False
     
+    def render_video_list(self) -> str:
+        """Get the Markdown catalog message, rebuilding it only after the catalog changes."""
+        if self._list_message_cache is None:
+            parts = ["🎬 *Available Videos* 🎬\n\n"]
+            for video in self.data["videos"].values():
+                parts.append(f"*{video['title']}*\n")
+                parts.append(f"Price: {video['price']} Stars\n")
+                parts.append(f"Duration: {video.get('duration', 'N/A')}\n\n")
+            self._list_message_cache = "".join(parts)
+        return self._list_message_cache
+    
+    def render_video_details(self, video_id: str) -> Optional[str]:
+        """Get the Markdown details message for a video, or None if it doesn't exist."""
+        message = self._details_message_cache.get(video_id)
+        if message is None:
+            video = self.data["videos"].get(video_id)
+            if video is None:
+                return None
+            parts = [
+                f"🎬 *{video['title']}* 🎬\n\n",
+                f"*Description:* {video['description']}\n\n",
+                f"*Price:* {video['price']} Stars\n",
+                f"*Duration:* {video.get('duration', 'N/A')}\n"
+            ]
+            if "category" in video:
+                parts.append(f"*Category:* {video['category']}\n")
+            if "tags" in video and video["tags"]:
+                parts.append(f"*Tags:* {', '.join(video['tags'])}\n")
+            message = "".join(parts)
+            self._details_message_cache[video_id] = message
+        return message
+    
     # User methods
     def add_user(self, user_id: int, username: str, is_admin: bool = False) -> None:
         """Add a new user or update existing user."""
-        if str(user_id) not in self.data["users"]:
-            self.data["users"][str(user_id)] = {
+        if user_id not in self.users:
+            user = {
                 "user_id": user_id,
                 "username": username,
                 "is_admin": is_admin,
                 "purchases": []
             }
-            self.save_database()
+            self.users[user_id] = user
+            if is_admin:
+                self._admin_ids.add(user_id)
+            self._append_journal({"op": "set_user", "id": user_id, "data": user})
+    
+    def iter_user_ids(self) -> Iterator[int]:
+        """Iterate over the IDs of all known users."""
+        return iter(list(self.users))
     
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user by ID."""
-        return self.data["users"].get(str(user_id))
+        return self.users.get(user_id)
     
     def is_admin(self, user_id: int) -> bool:
-        """Check if user is an admin."""
-        user = self.get_user(user_id)
-        return user is not None and user.get("is_admin", False)
+        """Check if user is an admin, either in the database or in config.ADMIN_USER_IDS."""
+        return user_id in self._admin_ids
     
     def add_purchase(self, user_id: int, video_id: str, price: int) -> bool:
         """Add a purchase record for a user."""
         user = self.get_user(user_id)
         if user:
-            import time
             purchase = {
                 "video_id": video_id,
                 "purchase_date": int(time.time()),
                 "price_paid": price
             }
             user["purchases"].append(purchase)
-            self.save_database()
+            self._purchased_index.setdefault(user_id, set()).add(video_id)
+            self._append_journal({"op": "add_purchase", "id": user_id, "data": purchase})
             return True
         return False
     
@@ -136,7 +417,30 @@ class Database:
             return user.get("purchases", [])
         return []
     
+    def get_purchases_with_videos(self, user_id: int) -> List[Dict[str, Any]]:
+        """Get all purchases for a user, each joined with its video (None if removed)."""
+        videos = self.data["videos"]
+        return [{**purchase, "video": videos.get(purchase["video_id"])} for purchase in self.get_user_purchases(user_id)]
+    
+    # Admin flow methods
+    def set_admin_state(self, user_id: int, state: str, payload: Optional[Dict[str, Any]] = None) -> None:
+        """Record the step an admin is at in a multi-message flow, with the data collected so far."""
+        entry = {"state": state, "payload": payload or {}}
+        self.admin_states[user_id] = entry
+        self._append_journal({"op": "set_admin_state", "id": user_id, "data": entry})
+    
+    def get_admin_state(self, user_id: int) -> Tuple[Optional[str], Dict[str, Any]]:
+        """Get an admin's current flow step and payload, or (None, {}) if no flow is active."""
+        entry = self.admin_states.get(user_id)
+        if entry is None:
+            return None, {}
+        return entry["state"], entry["payload"]
+    
+    def clear_admin_state(self, user_id: int) -> None:
+        """End an admin's current flow."""
+        if self.admin_states.pop(user_id, None) is not None:
+            self._append_journal({"op": "clear_admin_state", "id": user_id})
+    
     def has_purchased(self, user_id: int, video_id: str) -> bool:
         """Check if user has purchased a specific video."""
-        purchases = self.get_user_purchases(user_id)
-        return any(p["video_id"] == video_id for p in purchases)
+        return video_id in self._purchased_index.get(user_id, ())
@@ -3,10 +3,15 @@ Main module for the Telegram bot with integrated payment system.
 Handles command processing, bot interactions, and payments.
 """
 
+from datetime import datetime
+import functools
 import logging
 import asyncio
+import re
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     Application, 
     CommandHandler, 
     MessageHandler, 
@@ -24,30 +29,205 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# Keep the per-request chatter of the HTTP client and the library out of the log
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("telegram").setLevel(logging.WARNING)
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Initialize database and payment handler
 db = Database(config.DATABASE_FILE)
 payment_handler = PaymentHandler(db)
 
+# Date format used when listing purchases
+PURCHASE_DATE_FORMAT = '%Y-%m-%d'
+
+# Static keyboards and messages, built once at import time
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
+BACK_TO_ADMIN_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")]])
+
+MAIN_MENU_USER_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎬 Browse Videos", callback_data="browse_videos")],
+    [InlineKeyboardButton("🛒 My Purchases", callback_data="view_purchases")],
+    [InlineKeyboardButton("ℹ️ Help", callback_data="show_help")]
+])
+MAIN_MENU_ADMIN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎬 Browse Videos", callback_data="browse_videos")],
+    [InlineKeyboardButton("🛒 My Purchases", callback_data="view_purchases")],
+    [InlineKeyboardButton("ℹ️ Help", callback_data="show_help")],
+    [InlineKeyboardButton("🔐 Admin Panel", callback_data="admin_panel")]
+])
+
+HELP_USER_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎬 Browse Videos", callback_data="browse_videos")],
+    [InlineKeyboardButton("🛒 My Purchases", callback_data="view_purchases")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
+])
+HELP_ADMIN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎬 Browse Videos", callback_data="browse_videos")],
+    [InlineKeyboardButton("🛒 My Purchases", callback_data="view_purchases")],
+    [InlineKeyboardButton("🔐 Admin Panel", callback_data="admin_panel")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
+])
+
+ADMIN_PANEL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Add Video", callback_data="admin_add_video")],
+    [InlineKeyboardButton("View All Videos", callback_data="admin_view_videos")],
+    [InlineKeyboardButton("Broadcast Message", callback_data="admin_broadcast")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
+])
+VIDEO_ADDED_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("View All Videos", callback_data="admin_view_videos")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
+])
+BROADCAST_SENT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
+])
+ADMIN_PANEL_TEXT = (
+    "🔐 *Admin Panel* 🔐\n\n"
+    "Select an option:"
+)
+
+WELCOME_BACK_TEXT = (
+    "👋 Welcome to the Video Sales Bot!\n\n"
+    "You can browse and purchase videos using Telegram Stars.\n\n"
+    "Use the buttons below to navigate:"
+)
+
+HELP_COMMAND_TEXT = (
+    "🎬 *Video Sales Bot Help* 🎬\n\n"
+    "*User Commands:*\n"
+    "/start - Show main menu with buttons\n"
+    "/list - Browse all available videos\n"
+    "/mypurchases - View your purchased videos\n"
+)
+HELP_COMMAND_ADMIN_TEXT = HELP_COMMAND_TEXT + (
+    "\n*Admin Commands:*\n"
+    "/admin - Access admin panel\n"
+    "/addvideo - Add a new video\n"
+    "/removevideo [video_id] - Remove a video\n"
+    "/broadcast - Send a message to all users\n"
+)
+
+HELP_ACTIONS_TEXT = (
+    "🎬 *Video Sales Bot Help* 🎬\n\n"
+    "*Available Actions:*\n"
+    "• Browse Videos - See all available videos\n"
+    "• My Purchases - View your purchased videos\n"
+)
+HELP_ACTIONS_ADMIN_TEXT = HELP_ACTIONS_TEXT + (
+    "\n*Admin Actions:*\n"
+    "• Admin Panel - Manage videos and users\n"
+    "• Add Video - Upload new videos for sale\n"
+    "• Remove Video - Delete existing videos\n"
+    "• Broadcast - Send messages to all users\n"
+)
+
+NO_PERMISSION_TEXT = "You don't have permission to access admin features."
+
+# (catalog_version, text, markup) for the public catalog and the admin video list
+_catalog_render = None
+_admin_catalog_render = None
+
+def _catalog_view() -> tuple:
+    """Get the catalog message and keyboard, rebuilding them only after the catalog changes."""
+    global _catalog_render
+    if _catalog_render is None or _catalog_render[0] != db.catalog_version:
+        keyboard = []
+        for video_id, video in db.get_all_videos().items():
+            # Add buttons for each video
+            title = video['title']
+            keyboard.append([InlineKeyboardButton(f"Buy: {title}", callback_data=f"buy_{video_id}")])
+            keyboard.append([InlineKeyboardButton(f"View Details: {title}", callback_data=f"view_details_{video_id}")])
+        
+        # Add navigation buttons
+        keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
+        _catalog_render = (db.catalog_version, db.render_video_list(), InlineKeyboardMarkup(keyboard))
+    return _catalog_render[1], _catalog_render[2]
+
+def _admin_catalog_view() -> tuple:
+    """Get the admin video list message and keyboard, rebuilding them only after the catalog changes."""
+    global _admin_catalog_render
+    if _admin_catalog_render is None or _admin_catalog_render[0] != db.catalog_version:
+        parts = ["🎬 *All Videos* 🎬\n\n"]
+        keyboard = []
+        
+        for video_id, video in db.get_all_videos().items():
+            title = video['title']
+            parts.append(f"*{title}*\nID: `{video_id}`\nPrice: {video['price']} Stars\n\n")
+            keyboard.append([InlineKeyboardButton(f"Remove: {title}", callback_data=f"admin_remove_{video_id}")])
+        
+        keyboard.append([InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")])
+        _admin_catalog_render = (db.catalog_version, "".join(parts), InlineKeyboardMarkup(keyboard))
+    return _admin_catalog_render[1], _admin_catalog_render[2]
+
+def _render_videos_list() -> tuple:
+    """Get the catalog message and keyboard shared by /list and the Browse Videos button."""
+    if not db.get_all_videos():
+        return "No videos available at the moment.", MAIN_MENU_MARKUP
+    return _catalog_view()
+
+def _render_purchases(user_id: int) -> tuple:
+    """Get a user's purchases message and keyboard shared by /mypurchases and the My Purchases button."""
+    purchases = db.get_purchases_with_videos(user_id)
+    
+    if not purchases:
+        return "You haven't purchased any videos yet.", MAIN_MENU_MARKUP
+    
+    parts = ["🎬 *Your Purchased Videos* 🎬\n\n"]
+    keyboard = []
+    
+    for purchase in purchases:
+        video_id = purchase["video_id"]
+        video = purchase["video"]
+        
+        if video:
+            purchase_date = datetime.fromtimestamp(purchase["purchase_date"]).strftime(PURCHASE_DATE_FORMAT)
+            
+            parts.append(f"*{video['title']}*\n")
+            parts.append(f"Purchased on: {purchase_date}\n")
+            parts.append(f"Price paid: {purchase['price_paid']} Stars\n\n")
+            
+            # Add button to view this video
+            keyboard.append([InlineKeyboardButton(f"Watch {video['title']}", callback_data=f"watch_{video_id}")])
+    
+    # Add navigation button
+    keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
+    
+    return "".join(parts), InlineKeyboardMarkup(keyboard)
+
+# One lock per chat, so concurrently handled updates from the same chat still run in order.
+# Each entry is [lock, number of updates holding or waiting for it] and is dropped once that reaches zero.
+_chat_locks = {}
+
+def per_chat(handler):
+    """Run a handler under its chat's lock."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat_id = update.effective_chat.id
+        entry = _chat_locks.get(chat_id)
+        if entry is None:
+            entry = _chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await handler(update, context)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del _chat_locks[chat_id]
+    return wrapper
+
 # Command handlers
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message when the command /start is issued."""
     user = update.effective_user
-    db.add_user(user.id, user.username or "")
-    
-    # Create inline keyboard with main options
-    keyboard = [
-        [InlineKeyboardButton("🎬 Browse Videos", callback_data="browse_videos")],
-        [InlineKeyboardButton("🛒 My Purchases", callback_data="view_purchases")],
-        [InlineKeyboardButton("ℹ️ Help", callback_data="show_help")]
-    ]
+    user_id = user.id
+    db.add_user(user_id, user.username or "")
     
-    # Add admin button only for admins
-    if db.is_admin(user.id) or user.id in config.ADMIN_USER_IDS:
-        keyboard.append([InlineKeyboardButton("🔐 Admin Panel", callback_data="admin_panel")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Show the admin button only for admins
+    reply_markup = MAIN_MENU_ADMIN_MARKUP if db.is_admin(user_id) else MAIN_MENU_USER_MARKUP
     
     await update.message.reply_text(
         f"👋 Welcome, {user.first_name}!\n\n"
@@ -59,95 +239,25 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
     user = update.effective_user
-    is_admin = db.is_admin(user.id) or user.id in config.ADMIN_USER_IDS
-    
-    help_text = "🎬 *Video Sales Bot Help* 🎬\n\n"
-    help_text += "*User Commands:*\n"
-    help_text += "/start - Show main menu with buttons\n"
-    help_text += "/list - Browse all available videos\n"
-    help_text += "/mypurchases - View your purchased videos\n"
     
     # Only show admin commands to admins
-    if is_admin:
-        help_text += "\n*Admin Commands:*\n"
-        help_text += "/admin - Access admin panel\n"
-        help_text += "/addvideo - Add a new video\n"
-        help_text += "/removevideo [video_id] - Remove a video\n"
-        help_text += "/broadcast - Send a message to all users\n"
-    
-    # Create inline keyboard with main options
-    keyboard = [
-        [InlineKeyboardButton("🎬 Browse Videos", callback_data="browse_videos")],
-        [InlineKeyboardButton("🛒 My Purchases", callback_data="view_purchases")]
-    ]
-    
-    # Add admin button only for admins
-    if is_admin:
-        keyboard.append([InlineKeyboardButton("🔐 Admin Panel", callback_data="admin_panel")])
-    
-    keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if db.is_admin(user.id):
+        help_text, reply_markup = HELP_COMMAND_ADMIN_TEXT, HELP_ADMIN_MARKUP
+    else:
+        help_text, reply_markup = HELP_COMMAND_TEXT, HELP_USER_MARKUP
     
     await update.message.reply_text(help_text, parse_mode='Markdown', reply_markup=reply_markup)
 
 async def list_videos_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """List all available videos."""
-    videos = db.get_all_videos()
-    
-    if not videos:
-        await update.message.reply_text("No videos available at the moment.")
-        return
-    
-    message = "🎬 *Available Videos* 🎬\n\n"
-    
-    # Create keyboard with buttons for each video
-    keyboard = []
-    
-    for video_id, video in videos.items():
-        message += f"*{video['title']}*\n"
-        message += f"Price: {video['price']} Stars\n"
-        message += f"Duration: {video.get('duration', 'N/A')}\n\n"
-        
-        # Add button for each video
-        keyboard.append([InlineKeyboardButton(f"Buy: {video['title']}", callback_data=f"buy_{video_id}")])
-        keyboard.append([InlineKeyboardButton(f"View Details: {video['title']}", callback_data=f"view_details_{video_id}")])
-    
-    # Add navigation buttons
-    keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    message, reply_markup = _render_videos_list()
     await update.message.reply_text(message, parse_mode='Markdown', reply_markup=reply_markup)
 
 # Inline version of list_videos for callback handling
 async def list_videos_inline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """List all available videos for inline callback."""
-    query = update.callback_query
-    videos = db.get_all_videos()
-    
-    if not videos:
-        await query.edit_message_text("No videos available at the moment.",
-                                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]]))
-        return
-    
-    message = "🎬 *Available Videos* 🎬\n\n"
-    
-    # Create keyboard with buttons for each video
-    keyboard = []
-    
-    for video_id, video in videos.items():
-        message += f"*{video['title']}*\n"
-        message += f"Price: {video['price']} Stars\n"
-        message += f"Duration: {video.get('duration', 'N/A')}\n\n"
-        
-        # Add button for each video
-        keyboard.append([InlineKeyboardButton(f"Buy: {video['title']}", callback_data=f"buy_{video_id}")])
-        keyboard.append([InlineKeyboardButton(f"View Details: {video['title']}", callback_data=f"view_details_{video_id}")])
-    
-    # Add navigation buttons
-    keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+    message, reply_markup = _render_videos_list()
+    await update.callback_query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
 
 async def view_video_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """View details of a specific video."""
@@ -176,15 +286,7 @@ async def view_video_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Implementation depends on how previews are stored
         pass
     
-    message = f"🎬 *{video['title']}* 🎬\n\n"
-    message += f"*Description:* {video['description']}\n\n"
-    message += f"*Price:* {video['price']} Stars\n"
-    message += f"*Duration:* {video.get('duration', 'N/A')}\n"
-    if "category" in video:
-        message += f"*Category:* {video['category']}\n"
-    if "tags" in video and video["tags"]:
-        message += f"*Tags:* {', '.join(video['tags'])}\n"
-    
+    message = db.render_video_details(video_id)
     await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def buy_video_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -200,119 +302,47 @@ async def buy_video_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text(f"Video with ID {video_id} not found.")
         return
     
-    # Create a callback query-like object for the payment handler
-    class DummyCallbackQuery:
-        def __init__(self, message):
-            self.message = message
-    
-    update.callback_query = DummyCallbackQuery(update.message)
     await payment_handler.create_invoice(update, context, video_id)
     
     # Payment process will continue in the callback handler
 
 async def my_purchases_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show user's purchased videos."""
-    user_id = update.effective_user.id
-    purchases = db.get_user_purchases(user_id)
-    
-    if not purchases:
-        await update.message.reply_text(
-            "You haven't purchased any videos yet.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
-        )
-        return
-    
-    message = "🎬 *Your Purchased Videos* 🎬\n\n"
-    keyboard = []
-    
-    for purchase in purchases:
-        video_id = purchase["video_id"]
-        video = db.get_video(video_id)
-        
-        if video:
-            import datetime
-            purchase_date = datetime.datetime.fromtimestamp(purchase["purchase_date"]).strftime('%Y-%m-%d')
-            
-            message += f"*{video['title']}*\n"
-            message += f"Purchased on: {purchase_date}\n"
-            message += f"Price paid: {purchase['price_paid']} Stars\n\n"
-            
-            # Add button to view this video
-            keyboard.append([InlineKeyboardButton(f"Watch {video['title']}", callback_data=f"watch_{video_id}")])
-    
-    # Add navigation button
-    keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    message, reply_markup = _render_purchases(update.effective_user.id)
     await update.message.reply_text(message, parse_mode='Markdown', reply_markup=reply_markup)
 
 # Inline version of my_purchases for callback handling
 async def my_purchases_inline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show user's purchased videos for inline callback."""
-    query = update.callback_query
-    user_id = update.effective_user.id
-    purchases = db.get_user_purchases(user_id)
-    
-    if not purchases:
-        await query.edit_message_text(
-            "You haven't purchased any videos yet.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
-        )
-        return
-    
-    message = "🎬 *Your Purchased Videos* 🎬\n\n"
-    keyboard = []
-    
-    for purchase in purchases:
-        video_id = purchase["video_id"]
-        video = db.get_video(video_id)
-        
-        if video:
-            import datetime
-            purchase_date = datetime.datetime.fromtimestamp(purchase["purchase_date"]).strftime('%Y-%m-%d')
-            
-            message += f"*{video['title']}*\n"
-            message += f"Purchased on: {purchase_date}\n"
-            message += f"Price paid: {purchase['price_paid']} Stars\n\n"
-            
-            # Add button to view this video
-            keyboard.append([InlineKeyboardButton(f"Watch {video['title']}", callback_data=f"watch_{video_id}")])
-    
-    # Add navigation button
-    keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+    message, reply_markup = _render_purchases(update.effective_user.id)
+    await update.callback_query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
 
 # Admin commands
+async def require_admin(update: Update, user_id: int) -> bool:
+    """Check admin access for a command, replying with a permission error if denied."""
+    if not db.is_admin(user_id):
+        await update.message.reply_text(
+            NO_PERMISSION_TEXT,
+            reply_markup=MAIN_MENU_MARKUP
+        )
+        return False
+    return True
+
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Access admin panel."""
-    user_id = update.effective_user.id
+    user = update.effective_user
+    user_id = user.id
     
-    if not db.is_admin(user_id) and user_id not in config.ADMIN_USER_IDS:
-        await update.message.reply_text(
-            "You don't have permission to access admin features.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
-        )
+    if not await require_admin(update, user_id):
         return
     
-    # If user is not in database as admin but is in config, add them
-    if not db.is_admin(user_id) and user_id in config.ADMIN_USER_IDS:
-        user = update.effective_user
+    # If a config admin has no user record yet, add them as admin
+    if db.get_user(user_id) is None:
         db.add_user(user_id, user.username or "", is_admin=True)
     
-    keyboard = [
-        [InlineKeyboardButton("Add Video", callback_data="admin_add_video")],
-        [InlineKeyboardButton("View All Videos", callback_data="admin_view_videos")],
-        [InlineKeyboardButton("Broadcast Message", callback_data="admin_broadcast")],
-        [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
-        "🔐 *Admin Panel* 🔐\n\n"
-        "Select an option:",
-        reply_markup=reply_markup,
+        ADMIN_PANEL_TEXT,
+        reply_markup=ADMIN_PANEL_MARKUP,
         parse_mode='Markdown'
     )
 
@@ -320,25 +350,17 @@ async def add_video_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Start the process of adding a new video."""
     user_id = update.effective_user.id
     
-    if not db.is_admin(user_id) and user_id not in config.ADMIN_USER_IDS:
-        await update.message.reply_text(
-            "You don't have permission to access admin features.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
-        )
+    if not await require_admin(update, user_id):
         return
     
-    context.user_data["admin_state"] = "waiting_for_video_title"
+    db.set_admin_state(user_id, "waiting_for_video_title")
     await update.message.reply_text("Please send the title for the new video:")
 
 async def remove_video_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Remove a video from the catalog."""
     user_id = update.effective_user.id
     
-    if not db.is_admin(user_id) and user_id not in config.ADMIN_USER_IDS:
-        await update.message.reply_text(
-            "You don't have permission to access admin features.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
-        )
+    if not await require_admin(update, user_id):
         return
     
     if not context.args or len(context.args) < 1:
@@ -349,224 +371,213 @@ async def remove_video_command(update: Update, context: ContextTypes.DEFAULT_TYP
     success = db.remove_video(video_id)
     
     if success:
+        payment_handler.forget_video(video_id)
         await update.message.reply_text(
             f"Video with ID {video_id} has been removed.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
+            reply_markup=MAIN_MENU_MARKUP
         )
     else:
         await update.message.reply_text(
             f"Video with ID {video_id} not found.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
+            reply_markup=MAIN_MENU_MARKUP
         )
 
-# Callback query handler
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle button callbacks."""
-    query = update.callback_query
-    await query.answer()
-    
-    data = query.data
-    user_id = update.effective_user.id
-    is_admin = db.is_admin(user_id) or user_id in config.ADMIN_USER_IDS
+# Callback query handlers
+async def _on_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the main menu."""
+    # Show the admin button only for admins
+    await update.callback_query.edit_message_text(
+        WELCOME_BACK_TEXT,
+        reply_markup=MAIN_MENU_ADMIN_MARKUP if db.is_admin(update.effective_user.id) else MAIN_MENU_USER_MARKUP
+    )
+
+async def _on_show_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the help message."""
+    # Only show admin info to admins
+    if db.is_admin(update.effective_user.id):
+        help_text, reply_markup = HELP_ACTIONS_ADMIN_TEXT, HELP_ADMIN_MARKUP
+    else:
+        help_text, reply_markup = HELP_ACTIONS_TEXT, HELP_USER_MARKUP
     
-    # Main menu navigation
-    if data == "main_menu":
-        # Create inline keyboard with main options
-        keyboard = [
-            [InlineKeyboardButton("🎬 Browse Videos", callback_data="browse_videos")],
-            [InlineKeyboardButton("🛒 My Purchases", callback_data="view_purchases")],
-            [InlineKeyboardButton("ℹ️ Help", callback_data="show_help")]
-        ]
-        
-        # Add admin button only for admins
-        if is_admin:
-            keyboard.append([InlineKeyboardButton("🔐 Admin Panel", callback_data="admin_panel")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+    await update.callback_query.edit_message_text(help_text, parse_mode='Markdown', reply_markup=reply_markup)
+
+async def _on_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the admin panel."""
+    await update.callback_query.edit_message_text(
+        ADMIN_PANEL_TEXT,
+        reply_markup=ADMIN_PANEL_MARKUP,
+        parse_mode='Markdown'
+    )
+
+async def _on_cancel_buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Cancel a purchase."""
+    await update.callback_query.edit_message_text("Purchase cancelled.")
+
+async def _on_admin_add_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Start the add-video flow."""
+    db.set_admin_state(update.effective_user.id, "waiting_for_video_title")
+    await update.callback_query.edit_message_text("Please send the title for the new video:")
+
+async def _on_admin_view_videos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """List all videos with remove buttons."""
+    query = update.callback_query
+    videos = db.get_all_videos()
+    if not videos:
         await query.edit_message_text(
-            f"👋 Welcome to the Video Sales Bot!\n\n"
-            f"You can browse and purchase videos using Telegram Stars.\n\n"
-            f"Use the buttons below to navigate:",
-            reply_markup=reply_markup
+            "No videos in the database.",
+            reply_markup=BACK_TO_ADMIN_MARKUP
         )
+        return
     
-    # Help command
-    elif data == "show_help":
-        help_text = "🎬 *Video Sales Bot Help* 🎬\n\n"
-        help_text += "*Available Actions:*\n"
-        help_text += "• Browse Videos - See all available videos\n"
-        help_text += "• My Purchases - View your purchased videos\n"
-        
-        # Only show admin info to admins
-        if is_admin:
-            help_text += "\n*Admin Actions:*\n"
-            help_text += "• Admin Panel - Manage videos and users\n"
-            help_text += "• Add Video - Upload new videos for sale\n"
-            help_text += "• Remove Video - Delete existing videos\n"
-            help_text += "• Broadcast - Send messages to all users\n"
-        
-        # Create inline keyboard with main options
-        keyboard = [
-            [InlineKeyboardButton("🎬 Browse Videos", callback_data="browse_videos")],
-            [InlineKeyboardButton("🛒 My Purchases", callback_data="view_purchases")]
-        ]
-        
-        # Add admin button only for admins
-        if is_admin:
-            keyboard.append([InlineKeyboardButton("🔐 Admin Panel", callback_data="admin_panel")])
-        
-        keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(help_text, parse_mode='Markdown', reply_markup=reply_markup)
-    
-    # Browse videos
-    elif data == "browse_videos":
-        await list_videos_inline(update, context)
-    
-    # View purchases
-    elif data == "view_purchases":
-        await my_purchases_inline(update, context)
-    
-    # Admin panel
-    elif data == "admin_panel":
-        if not is_admin:
-            await query.edit_message_text(
-                "You don't have permission to access admin features.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
-            )
-            return
-            
+    message, reply_markup = _admin_catalog_view()
+    await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+
+async def _on_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Start the broadcast flow."""
+    db.set_admin_state(update.effective_user.id, "waiting_for_broadcast")
+    await update.callback_query.edit_message_text("Please send the message you want to broadcast to all users:")
+
+async def _on_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str) -> None:
+    """Send an invoice for a video."""
+    await payment_handler.create_invoice(update, context, video_id)
+
+async def _on_confirm_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str) -> None:
+    """Handle the legacy confirm button."""
+    # This callback is no longer used as we now use the real Stars payment system
+    # All purchases are handled through pre_checkout_query and successful_payment handlers
+    await update.callback_query.edit_message_text("Please use the Buy button to purchase videos with Stars.")
+
+async def _on_watch(update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str) -> None:
+    """Deliver a purchased video."""
+    # Check if user has actually purchased this video
+    if db.has_purchased(update.effective_user.id, video_id):
+        await payment_handler.deliver_video(update, context, video_id, verify_ownership=False)
+    else:
+        await update.callback_query.edit_message_text(
+            "You need to purchase this video before watching it.",
+            reply_markup=MAIN_MENU_MARKUP
+        )
+
+async def _on_view_details(update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str) -> None:
+    """Show a video's details."""
+    message = db.render_video_details(video_id)
+    
+    if message:
+        # Create keyboard with buy button
         keyboard = [
-            [InlineKeyboardButton("Add Video", callback_data="admin_add_video")],
-            [InlineKeyboardButton("View All Videos", callback_data="admin_view_videos")],
-            [InlineKeyboardButton("Broadcast Message", callback_data="admin_broadcast")],
-            [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
+            [InlineKeyboardButton("Buy Now", callback_data=f"buy_{video_id}")],
+            [InlineKeyboardButton("🔙 Back to Videos", callback_data="browse_videos")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(
-            "🔐 *Admin Panel* 🔐\n\n"
-            "Select an option:",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
-    
-    # Buy video
-    elif data.startswith("buy_"):
-        video_id = data.split("_", 1)[1]  # Split only on first underscore
-        await payment_handler.create_invoice(update, context, video_id)
-    
-    elif data.startswith("confirm_buy_"):
-        # This callback is no longer used as we now use the real Stars payment system
-        # All purchases are handled through pre_checkout_query and successful_payment handlers
-        await query.edit_message_text("Please use the Buy button to purchase videos with Stars.")
-    
-    elif data == "cancel_buy":
-        await query.edit_message_text("Purchase cancelled.")
-    
-    # Watch video
-    elif data.startswith("watch_"):
-        video_id = data.split("_", 1)[1]  # Split only on first underscore
-        # Check if user has actually purchased this video
-        if db.has_purchased(user_id, video_id):
-            await payment_handler.deliver_video(update, context, video_id)
-        else:
-            await query.edit_message_text(
-                "You need to purchase this video before watching it.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
-            )
+        await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+
+async def _on_admin_remove(update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str) -> None:
+    """Remove a video."""
+    success = db.remove_video(video_id)
     
-    # View video details
-    elif data.startswith("view_details_"):
-        video_id = data.split("_", 2)[2]  # Split only on first two underscores
-        video = db.get_video(video_id)
-        
-        if video:
-            # Create keyboard with buy button
-            keyboard = [
-                [InlineKeyboardButton("Buy Now", callback_data=f"buy_{video_id}")],
-                [InlineKeyboardButton("🔙 Back to Videos", callback_data="browse_videos")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            message = f"🎬 *{video['title']}* 🎬\n\n"
-            message += f"*Description:* {video['description']}\n\n"
-            message += f"*Price:* {video['price']} Stars\n"
-            message += f"*Duration:* {video.get('duration', 'N/A')}\n"
-            if "category" in video:
-                message += f"*Category:* {video['category']}\n"
-            if "tags" in video and video["tags"]:
-                message += f"*Tags:* {', '.join(video['tags'])}\n"
-            
-            await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    if success:
+        payment_handler.forget_video(video_id)
+        await update.callback_query.edit_message_text(
+            f"Video with ID {video_id} has been removed.\n\nClick below to return to admin panel.",
+            reply_markup=BACK_TO_ADMIN_MARKUP
+        )
+    else:
+        await update.callback_query.edit_message_text(
+            f"Video with ID {video_id} not found.\n\nClick below to return to admin panel.",
+            reply_markup=BACK_TO_ADMIN_MARKUP
+        )
+
+# Callback handlers for fixed callback data
+EXACT_CALLBACK_HANDLERS = {
+    "main_menu": _on_main_menu,
+    "show_help": _on_show_help,
+    "browse_videos": list_videos_inline,
+    "view_purchases": my_purchases_inline,
+    "admin_panel": _on_admin_panel,
+    "cancel_buy": _on_cancel_buy,
+    "admin_add_video": _on_admin_add_video,
+    "admin_view_videos": _on_admin_view_videos,
+    "admin_broadcast": _on_admin_broadcast,
+}
+
+# Callback handlers for "<kind>_<video_id>" callback data, receiving the video ID
+PREFIX_CALLBACK_HANDLERS = {
+    "buy": _on_buy,
+    "confirm_buy": _on_confirm_buy,
+    "watch": _on_watch,
+    "view_details": _on_view_details,
+    "admin_remove": _on_admin_remove,
+}
+
+# Splits "<kind>_<video_id>" callback data in a single match
+_CB_RE = re.compile(r"^(buy|watch|view_details|admin_remove|confirm_buy)_(.+)$")
+
+@per_chat
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle button callbacks."""
+    query = update.callback_query
+    await query.answer()
     
-    # Admin callbacks
-    elif data.startswith("admin_") and is_admin:
-        if data == "admin_add_video":
-            context.user_data["admin_state"] = "waiting_for_video_title"
-            await query.edit_message_text("Please send the title for the new video:")
-        
-        elif data == "admin_view_videos":
-            videos = db.get_all_videos()
-            if not videos:
-                await query.edit_message_text(
-                    "No videos in the database.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")]])
-                )
-                return
-            
-            message = "🎬 *All Videos* 🎬\n\n"
-            keyboard = []
-            
-            for video_id, video in videos.items():
-                message += f"*{video['title']}*\n"
-                message += f"ID: `{video_id}`\n"
-                message += f"Price: {video['price']} Stars\n\n"
-                keyboard.append([InlineKeyboardButton(f"Remove: {video['title']}", callback_data=f"admin_remove_{video_id}")])
-            
-            keyboard.append([InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
-        
-        elif data.startswith("admin_remove_"):
-            video_id = data.split("_", 2)[2]
-            success = db.remove_video(video_id)
-            
-            if success:
-                await query.edit_message_text(
-                    f"Video with ID {video_id} has been removed.\n\nClick below to return to admin panel.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")]])
-                )
-            else:
-                await query.edit_message_text(
-                    f"Video with ID {video_id} not found.\n\nClick below to return to admin panel.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")]])
-                )
-        
-        elif data == "admin_broadcast":
-            context.user_data["admin_state"] = "waiting_for_broadcast"
-            await query.edit_message_text("Please send the message you want to broadcast to all users:")
+    data = query.data
     
     # Handle unauthorized admin access attempts
-    elif data.startswith("admin_") and not is_admin:
+    if data.startswith("admin_") and not db.is_admin(update.effective_user.id):
         await query.edit_message_text(
-            "You don't have permission to access admin features.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
+            NO_PERMISSION_TEXT,
+            reply_markup=MAIN_MENU_MARKUP
         )
+        return
+    
+    handler = EXACT_CALLBACK_HANDLERS.get(data)
+    if handler:
+        await handler(update, context)
+        return
+    
+    m = _CB_RE.match(data)
+    if m:
+        kind, video_id = m.groups()
+        await PREFIX_CALLBACK_HANDLERS[kind](update, context, video_id)
+
+# Maximum number of broadcast messages in flight at once
+BROADCAST_CONCURRENCY = 30
+
+async def broadcast(context: ContextTypes.DEFAULT_TYPE, text: str) -> int:
+    """Send a message to every known user concurrently and return how many were delivered."""
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    
+    async def send_one(recipient_id: int) -> bool:
+        async with semaphore:
+            try:
+                await context.bot.send_message(chat_id=recipient_id, text=text)
+                return True
+            except RetryAfter as e:
+                # The rate limiter has already retried this send, so don't hold the slot for more
+                logger.warning("Giving up on broadcast to user %s, still rate limited (retry after %s)",
+                               recipient_id, e.retry_after)
+                return False
+            except TelegramError as e:
+                logger.warning("Could not deliver broadcast to user %s: %s", recipient_id, e)
+                return False
+    
+    # The application's rate limiter remains the single throttle on Telegram's flood limits
+    results = await asyncio.gather(
+        *(send_one(recipient_id) for recipient_id in db.iter_user_ids()),
+        return_exceptions=True
+    )
+    return sum(result is True for result in results)
 
 # Message handler for admin operations
+@per_chat
 async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle messages for admin operations like adding videos."""
     user_id = update.effective_user.id
     
-    if not db.is_admin(user_id) and user_id not in config.ADMIN_USER_IDS:
+    if not db.is_admin(user_id):
         return
     
     try:
-        admin_state = context.user_data.get("admin_state", None)
+        admin_state, new_video = db.get_admin_state(user_id)
         
         if admin_state == "waiting_for_video_title":
             # Validate title
@@ -575,8 +586,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text("Title must be at least 3 characters long. Please try again:")
                 return
                 
-            context.user_data["new_video"] = {"title": title}
-            context.user_data["admin_state"] = "waiting_for_video_description"
+            db.set_admin_state(user_id, "waiting_for_video_description", {"title": title})
             await update.message.reply_text("Please send the description for the video:")
         
         elif admin_state == "waiting_for_video_description":
@@ -586,8 +596,8 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text("Description must be at least 10 characters long. Please try again:")
                 return
                 
-            context.user_data["new_video"]["description"] = description
-            context.user_data["admin_state"] = "waiting_for_video_price"
+            new_video["description"] = description
+            db.set_admin_state(user_id, "waiting_for_video_price", new_video)
             await update.message.reply_text("Please send the price in Stars for the video:")
         
         elif admin_state == "waiting_for_video_price":
@@ -597,8 +607,8 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     await update.message.reply_text("Price must be a positive number. Please try again:")
                     return
                     
-                context.user_data["new_video"]["price"] = price
-                context.user_data["admin_state"] = "waiting_for_video_duration"
+                new_video["price"] = price
+                db.set_admin_state(user_id, "waiting_for_video_duration", new_video)
                 await update.message.reply_text("Please send the duration of the video (e.g., 10:30):")
             except ValueError:
                 await update.message.reply_text("Please send a valid number for the price.")
@@ -610,36 +620,28 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text("Please send a valid duration.")
                 return
                 
-            context.user_data["new_video"]["duration"] = duration
-            context.user_data["admin_state"] = "waiting_for_video_file"
+            new_video["duration"] = duration
+            db.set_admin_state(user_id, "waiting_for_video_file", new_video)
             await update.message.reply_text("Please send the video file:")
         
         elif admin_state == "waiting_for_video_file":
             # Handle video file upload
             if update.message.video:
                 video = update.message.video
-                context.user_data["new_video"]["file_id"] = video.file_id
+                new_video["file_id"] = video.file_id
                 
                 try:
                     # Add the video to the database with validation
-                    new_video = context.user_data["new_video"]
                     video_id = db.add_video(new_video)
-                    
-                    # Create keyboard with main options
-                    keyboard = [
-                        [InlineKeyboardButton("View All Videos", callback_data="admin_view_videos")],
-                        [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
+                    payment_handler.prepare_invoice(video_id)
                     
                     await update.message.reply_text(
                         f"Video added successfully with ID: {video_id}",
-                        reply_markup=reply_markup
+                        reply_markup=VIDEO_ADDED_MARKUP
                     )
                     
                     # Clear admin state
-                    context.user_data.pop("admin_state", None)
-                    context.user_data.pop("new_video", None)
+                    db.clear_admin_state(user_id)
                 except ValueError as e:
                     await update.message.reply_text(f"Error adding video: {str(e)}")
             else:
@@ -652,20 +654,15 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text("Broadcast message must be at least 5 characters long. Please try again:")
                 return
                 
-            # In a real implementation, we would iterate through all users and send the message
-            keyboard = [
-                [InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")],
-                [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            sent = await broadcast(context, broadcast_message)
             
             await update.message.reply_text(
-                f"Broadcast message sent: {broadcast_message}",
-                reply_markup=reply_markup
+                f"Broadcast message sent to {sent} users: {broadcast_message}",
+                reply_markup=BROADCAST_SENT_MARKUP
             )
-            context.user_data.pop("admin_state", None)
+            db.clear_admin_state(user_id)
     except Exception as e:
-        logger.error(f"Error in admin message handler: {e}")
+        logger.error("Error in admin message handler: %s", e)
         await update.message.reply_text("An error occurred while processing your request. Please try again.")
 
 # Payment handlers
@@ -673,6 +670,7 @@ async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     """Handle the pre-checkout callback."""
     await payment_handler.handle_pre_checkout(update, context)
 
+@per_chat
 async def successful_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle successful payment."""
     await payment_handler.handle_successful_payment(update, context)
@@ -680,53 +678,73 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
 # Error handler
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log errors caused by updates."""
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused error %s", update, context.error)
     
     # Notify user of error
     if update.effective_message:
         await update.effective_message.reply_text(
             "Sorry, an error occurred while processing your request. Please try again later.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
+            reply_markup=MAIN_MENU_MARKUP
         )
 
+# Bot commands as (command, callback, block)
+COMMANDS = (
+    ("start", start_command, True),
+    ("help", help_command, True),
+    ("list", list_videos_command, False),
+    ("view", view_video_command, True),
+    ("buy", buy_video_command, True),
+    ("mypurchases", my_purchases_command, True),
+    ("admin", admin_command, True),
+    ("addvideo", add_video_command, True),
+    ("removevideo", remove_video_command, True),
+)
+
 def main() -> None:
     """Start the bot."""
-    # Create the Application
-    application = Application.builder().token(config.BOT_TOKEN).build()
-
-    # Add command handlers
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("list", list_videos_command))
-    application.add_handler(CommandHandler("view", view_video_command))
-    application.add_handler(CommandHandler("buy", buy_video_command))
-    application.add_handler(CommandHandler("mypurchases", my_purchases_command))
-    application.add_handler(CommandHandler("admin", admin_command))
-    application.add_handler(CommandHandler("addvideo", add_video_command))
-    application.add_handler(CommandHandler("removevideo", remove_video_command))
-    
-    # Add payment handlers
-    application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
-    
-    # Add callback query handler
-    application.add_handler(CallbackQueryHandler(button_callback))
-    
-    # Add message handler for admin operations
-    application.add_handler(MessageHandler((filters.TEXT | filters.VIDEO) & ~filters.COMMAND, handle_admin_message))
+    # Cache bot info in config once, after the application is initialized
+    async def post_init(application: Application) -> None:
+        bot_info = await application.bot.get_me()
+        config.BOT_USERNAME = bot_info.username
+        logger.info("Bot starting as @%s", config.BOT_USERNAME)
+    
+    # Let a background compaction finish before db.close() writes the final snapshot
+    async def post_shutdown(application: Application) -> None:
+        await db.wait_for_compaction()
+    
+    # Create the Application, throttling outgoing requests to Telegram's flood limits
+    # and handling updates concurrently so one slow API call doesn't stall every user
+    application = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .concurrent_updates(True)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    # Add command handlers, then the payment, callback query and admin message handlers
+    application.add_handlers([CommandHandler(name, callback, block=block) for name, callback, block in COMMANDS])
+    application.add_handlers([
+        PreCheckoutQueryHandler(precheckout_callback),
+        MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback, block=False),
+        CallbackQueryHandler(button_callback, block=False),
+        MessageHandler((filters.TEXT | filters.VIDEO) & ~filters.COMMAND, handle_admin_message, block=False)
+    ])
     
     # Add error handler
     application.add_error_handler(error_handler)
     
-    # Define post-init callback to run after application starts
-    async def post_init(application: Application) -> None:
-        bot_info = await application.bot.get_me()
-        config.BOT_USERNAME = bot_info.username
-        logger.info(f"Bot starting as @{config.BOT_USERNAME}")
+    # Start the Bot, long-polling only for the update types the handlers above use
+    application.run_polling(
+        poll_interval=0.0,
+        timeout=30,
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY, Update.PRE_CHECKOUT_QUERY]
+    )
     
-    # Start the Bot with post_init callback
-    application.post_init = post_init
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Fold the journal back into the snapshot on shutdown
+    db.close()
 
 if __name__ == '__main__':
     main()
@@ -10,15 +10,93 @@ from telegram import (
     InlineKeyboardMarkup
 )
 from telegram.ext import ContextTypes
+from typing import Any, Dict, Optional, Tuple
 from database import Database
 import config
 import logging
 
 logger = logging.getLogger(__name__)
 
+# User-facing reply texts, keyed by situation; entries with {fields} are filled with str.format
+MSG = {
+    "video_not_found": "Video with ID {video_id} not found.",
+    "already_purchased": "You've already purchased this video. Check your purchases to view it.",
+    "invoice_error": "Sorry, there was an error processing your payment request. Please try again later.",
+    "payment_error": "There was an error processing your payment.",
+    "purchase_confirmed": (
+        "✅ Thank you for your purchase of '{title}'!\n\n"
+        "You can access your purchased videos anytime using /mypurchases"
+    ),
+    "record_error": (
+        "Your payment was successful, but there was an error recording your purchase. "
+        "Please contact support."
+    ),
+    "delivery_unavailable": "There was an error delivering your video. Please contact support.",
+    "not_purchased": "You need to purchase this video before watching it.",
+    "delivery_failed": "There was an error delivering your video. Please try accessing it from /mypurchases",
+}
+
+# Shared "View My Purchases" keyboard, built once at import time
+VIEW_PURCHASES_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("View My Purchases", callback_data="view_purchases")]
+])
+
 class PaymentHandler:
     def __init__(self, database: Database):
         self.db = database
+        # Prebuilt send_invoice arguments per video, tagged with the video version they were built from
+        self._invoice_cache: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+        # Delivery captions per video, tagged with their video version the same way
+        self._caption_cache: Dict[str, Tuple[int, str]] = {}
+    
+    @staticmethod
+    async def _reply(update: Update, text: str, **kwargs: Any) -> None:
+        """Reply in the chat of a message or of the message a callback button is attached to."""
+        message = update.message or (update.callback_query and update.callback_query.message)
+        if message:
+            await message.reply_text(text, **kwargs)
+    
+    def prepare_invoice(self, video_id: str) -> None:
+        """Build a newly added video's invoice and caption up front so its first sale is served from cache."""
+        video = self.db.get_video(video_id)
+        if video:
+            self._invoice_kwargs(video_id, video)
+            self._delivery_caption(video_id, video)
+    
+    def forget_video(self, video_id: str) -> None:
+        """Drop cached data for a removed video."""
+        self._invoice_cache.pop(video_id, None)
+        self._caption_cache.pop(video_id, None)
+    
+    def _delivery_caption(self, video_id: str, video: Dict[str, Any]) -> str:
+        """Get the caption sent with a delivered video, rebuilding it only after the video changes."""
+        version = self.db.video_version(video_id)
+        cached = self._caption_cache.get(video_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        caption = f"🎬 {video['title']}\n\nEnjoy your video!"
+        self._caption_cache[video_id] = (version, caption)
+        return caption
+    
+    def _invoice_kwargs(self, video_id: str, video: Dict[str, Any]) -> Dict[str, Any]:
+        """Get the send_invoice arguments for a video, rebuilding them only after the video changes."""
+        version = self.db.video_version(video_id)
+        cached = self._invoice_cache.get(video_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        
+        # Create the invoice using Telegram Stars (XTR)
+        invoice = {
+            "title": f"Purchase: {video['title']}",
+            "description": video['description'][:255],  # Telegram limits description to 255 chars
+            "payload": f"video_{video_id}",
+            "provider_token": "",  # Empty for digital goods using Stars
+            "currency": "XTR",  # Using Telegram Stars currency
+            "prices": [LabeledPrice("Video", video['price'])],  # For Stars, don't multiply by 100
+            "start_parameter": f"buy-{video_id}"
+        }
+        self._invoice_cache[video_id] = (version, invoice)
+        return invoice
     
     async def create_invoice(self, update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str) -> bool:
         """Create a payment invoice for a video using Telegram Stars."""
@@ -26,60 +104,35 @@ class PaymentHandler:
         video = self.db.get_video(video_id)
         
         if not video:
-            await update.callback_query.message.reply_text(f"Video with ID {video_id} not found.")
+            await self._reply(update, MSG["video_not_found"].format(video_id=video_id))
             return False
         
         # Check if user already purchased this video
         if self.db.has_purchased(user_id, video_id):
-            keyboard = [
-                [InlineKeyboardButton("View My Purchases", callback_data="view_purchases")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.callback_query.message.reply_text(
-                f"You've already purchased this video. Check your purchases to view it.",
-                reply_markup=reply_markup
-            )
+            await self._reply(update, MSG["already_purchased"], reply_markup=VIEW_PURCHASES_MARKUP)
             return False
         
-        # Create the invoice using Telegram Stars (XTR)
-        title = f"Purchase: {video['title']}"
-        description = video['description'][:255]  # Telegram limits description to 255 chars
-        payload = f"video_{video_id}"
-        currency = "XTR"  # Using Telegram Stars currency
-        prices = [LabeledPrice("Video", video['price'])]  # For Stars, don't multiply by 100
-        
         try:
-            # For digital goods, provider_token is left empty as per Telegram documentation
             await context.bot.send_invoice(
                 chat_id=update.effective_chat.id,
-                title=title,
-                description=description,
-                payload=payload,
-                provider_token="",  # Empty for digital goods using Stars
-                currency=currency,
-                prices=prices,
-                start_parameter=f"buy-{video_id}"
+                **self._invoice_kwargs(video_id, video)
             )
             return True
         except Exception as e:
-            logger.error(f"Error creating invoice: {e}")
-            await update.callback_query.message.reply_text(
-                "Sorry, there was an error processing your payment request. Please try again later."
-            )
+            logger.error("Error creating invoice: %s", e)
+            await self._reply(update, MSG["invoice_error"])
             return False
     
     async def handle_pre_checkout(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle the pre-checkout callback."""
         query = update.pre_checkout_query
         
-        # Check if the payload is valid
-        if not query.invoice_payload.startswith("video_"):
+        # Check if the payload is valid and extract video_id from it
+        kind, _, video_id = query.invoice_payload.partition("_")
+        if kind != "video" or not video_id:
             await query.answer(ok=False, error_message="Invalid payment payload")
             return
         
-        # Extract video_id from payload
-        video_id = query.invoice_payload.split("_", 1)[1]
         video = self.db.get_video(video_id)
         
         if not video:
@@ -98,18 +151,18 @@ class PaymentHandler:
         """Handle successful payment."""
         payment = update.message.successful_payment
         
-        if not payment.invoice_payload.startswith("video_"):
-            logger.error(f"Invalid payment payload: {payment.invoice_payload}")
-            await update.message.reply_text("There was an error processing your payment.")
+        # Check if the payload is valid and extract video_id from it
+        kind, _, video_id = payment.invoice_payload.partition("_")
+        if kind != "video" or not video_id:
+            logger.error("Invalid payment payload: %s", payment.invoice_payload)
+            await self._reply(update, MSG["payment_error"])
             return
         
-        # Extract video_id from payload
-        video_id = payment.invoice_payload.split("_", 1)[1]
         video = self.db.get_video(video_id)
         
         if not video:
-            logger.error(f"Video not found for payment: {video_id}")
-            await update.message.reply_text("There was an error processing your payment.")
+            logger.error("Video not found for payment: %s", video_id)
+            await self._reply(update, MSG["payment_error"])
             return
         
         # Record the purchase
@@ -119,55 +172,39 @@ class PaymentHandler:
         
         if success:
             # Send the purchased video
-            await self.deliver_video(update, context, video_id)
+            # The purchase was just recorded, so ownership needn't be checked again
+            await self.deliver_video(update, context, video_id, verify_ownership=False, video=video)
             
             # Confirm purchase
-            keyboard = [
-                [InlineKeyboardButton("View My Purchases", callback_data="view_purchases")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                f"✅ Thank you for your purchase of '{video['title']}'!\n\n"
-                f"You can access your purchased videos anytime using /mypurchases",
-                reply_markup=reply_markup
+            await self._reply(
+                update,
+                MSG["purchase_confirmed"].format(title=video['title']),
+                reply_markup=VIEW_PURCHASES_MARKUP
             )
         else:
-            logger.error(f"Failed to record purchase for user {user_id}, video {video_id}")
-            await update.message.reply_text(
-                "Your payment was successful, but there was an error recording your purchase. "
-                "Please contact support."
-            )
+            logger.error("Failed to record purchase for user %s, video %s", user_id, video_id)
+            await self._reply(update, MSG["record_error"])
     
-    async def deliver_video(self, update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str) -> None:
-        """Deliver the purchased video to the user."""
-        video = self.db.get_video(video_id)
+    async def deliver_video(self, update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str,
+                            verify_ownership: bool = True, video: Optional[Dict[str, Any]] = None) -> None:
+        """Deliver the purchased video to the user.
+        
+        Callers that have just checked the purchase themselves can pass verify_ownership=False,
+        and callers that already looked the video up can pass it as video.
+        """
+        if video is None:
+            video = self.db.get_video(video_id)
         
         if not video or "file_id" not in video:
-            logger.error(f"Cannot deliver video {video_id}: Video not found or file_id missing")
+            logger.error("Cannot deliver video %s: Video not found or file_id missing", video_id)
             
-            # Determine how to send the error message based on the update type
-            if hasattr(update, 'message') and update.message:
-                await update.message.reply_text(
-                    "There was an error delivering your video. Please contact support."
-                )
-            elif hasattr(update, 'callback_query') and update.callback_query:
-                await update.callback_query.message.reply_text(
-                    "There was an error delivering your video. Please contact support."
-                )
+            await self._reply(update, MSG["delivery_unavailable"])
             return
         
         # Verify the user has purchased this video
         user_id = update.effective_user.id
-        if not self.db.has_purchased(user_id, video_id):
-            if hasattr(update, 'callback_query') and update.callback_query:
-                await update.callback_query.message.reply_text(
-                    "You need to purchase this video before watching it."
-                )
-            elif hasattr(update, 'message') and update.message:
-                await update.message.reply_text(
-                    "You need to purchase this video before watching it."
-                )
+        if verify_ownership and not self.db.has_purchased(user_id, video_id):
+            await self._reply(update, MSG["not_purchased"])
             return
         
         # Send the video using the stored file_id
@@ -175,15 +212,8 @@ class PaymentHandler:
             await context.bot.send_video(
                 chat_id=update.effective_chat.id,
                 video=video["file_id"],
-                caption=f"🎬 {video['title']}\n\nEnjoy your video!"
+                caption=self._delivery_caption(video_id, video)
             )
         except Exception as e:
-            logger.error(f"Error sending video: {e}")
-            if hasattr(update, 'message') and update.message:
-                await update.message.reply_text(
-                    "There was an error delivering your video. Please try accessing it from /mypurchases"
-                )
-            elif hasattr(update, 'callback_query') and update.callback_query:
-                await update.callback_query.message.reply_text(
-                    "There was an error delivering your video. Please try accessing it from /mypurchases"
-                )
+            logger.error("Error sending video: %s", e)
+            await self._reply(update, MSG["delivery_failed"])
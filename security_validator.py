@@ -5,9 +5,17 @@ Checks for security issues and provides recommendations.
 
 import os
 import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 
+# orjson is a bot dependency, but the validator can still run without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Set up logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -15,21 +23,84 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Patterns used by the checks, compiled once at import time; none spans more than one line
+TOKEN_RE = re.compile(r'BOT_TOKEN\s*=\s*["\'][0-9]+:[A-Za-z0-9_-]+["\']')
+ADMIN_CHECK_RE = re.compile(r'not db\.is_admin\(')
+PROVIDER_TOKEN_RE = re.compile(r'provider_token\s*=\s*config\.PAYMENT_PROVIDER_TOKEN')
+DB_EXISTS_RE = re.compile(r'os\.path\.exists.+database_file')
+VALIDATION_RE = re.compile(r'validate|validation', re.IGNORECASE)
+PATTERNS = {
+    "token": TOKEN_RE,
+    "admin_check": ADMIN_CHECK_RE,
+    "provider_token_config": PROVIDER_TOKEN_RE,
+    "db_exists": DB_EXISTS_RE,
+    "validation": VALIDATION_RE,
+}
+
+# Literal markers the checks look for, matched together on each line
+LITERALS = {
+    "admin_ids": "config.ADMIN_USER_IDS",
+    "pre_checkout": "handle_pre_checkout",
+    "provider_token": "provider_token",
+    "error_handler": "error_handler",
+    "try_block": "try:",
+}
+LITERALS_RE = re.compile("|".join(f"(?P<{name}>{re.escape(literal)})" for name, literal in LITERALS.items()))
+
 class SecurityValidator:
     def __init__(self, project_dir):
         self.project_dir = project_dir
         self.issues = []
         self.recommendations = []
+        self._scan_cache = {}
+        # List the project directory once instead of stat-ing each file the checks look at
+        try:
+            with os.scandir(project_dir) as entries:
+                self.files = {entry.name: entry.path for entry in entries if entry.is_file()}
+        except FileNotFoundError:
+            self.files = {}
+    
+    def _scan(self, filename):
+        """Stream a project file once, counting LITERALS hits and the lines matching each of PATTERNS.
+        
+        Returns a Counter keyed by marker and pattern name, or None if the file doesn't exist.
+        """
+        if filename not in self._scan_cache:
+            path = self.files.get(filename)
+            hits = None
+            if path:
+                hits = Counter()
+                with open(path, 'r') as f:
+                    for line in f:
+                        hits.update(m.lastgroup for m in LITERALS_RE.finditer(line))
+                        for name, pattern in PATTERNS.items():
+                            if pattern.search(line):
+                                hits[name] += 1
+            self._scan_cache[filename] = hits
+        return self._scan_cache[filename]
     
     def validate_all(self):
         """Run all security validation checks."""
         logger.info("Starting security validation...")
         
-        self.check_token_exposure()
-        self.check_admin_access_control()
-        self.check_payment_security()
-        self.check_user_data_protection()
-        self.check_error_handling()
+        # Load every file up front so the checks below only read shared caches
+        for filename in ("config.py", "main.py", "payment.py", "database.py"):
+            self._scan(filename)
+        
+        checks = [
+            self.check_token_exposure,
+            self.check_admin_access_control,
+            self.check_payment_security,
+            self.check_user_data_protection,
+            self.check_error_handling
+        ]
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            results = list(executor.map(lambda check: check(), checks))
+        
+        # Merge in check order so the report reads the same as a serial run
+        for issues, recommendations in results:
+            self.issues.extend(issues)
+            self.recommendations.extend(recommendations)
         
         return {
             "issues": self.issues,
@@ -40,114 +111,128 @@ class SecurityValidator:
     def check_token_exposure(self):
         """Check if bot token is exposed in code or version control."""
         logger.info("Checking for token exposure...")
+        issues = []
+        recommendations = []
         
         # Check if token is in config file
-        config_file = os.path.join(self.project_dir, "config.py")
-        if os.path.exists(config_file):
-            with open(config_file, 'r') as f:
-                content = f.read()
-                if re.search(r'BOT_TOKEN\s*=\s*["\'][0-9]+:[A-Za-z0-9_-]+["\']', content):
-                    self.issues.append("Bot token is hardcoded in config.py")
-                    self.recommendations.append(
-                        "Move bot token to environment variables or a separate .env file "
-                        "that is excluded from version control"
-                    )
+        scan = self._scan("config.py")
+        if scan is not None:
+            if scan["token"]:
+                issues.append("Bot token is hardcoded in config.py")
+                recommendations.append(
+                    "Move bot token to environment variables or a separate .env file "
+                    "that is excluded from version control"
+                )
         
         # Check for .gitignore
-        gitignore_file = os.path.join(self.project_dir, ".gitignore")
-        if not os.path.exists(gitignore_file):
-            self.recommendations.append(
+        if ".gitignore" not in self.files:
+            recommendations.append(
                 "Create a .gitignore file to exclude sensitive files like .env, "
                 "config files with tokens, and database files"
             )
+        
+        return issues, recommendations
     
     def check_admin_access_control(self):
         """Check if admin access is properly restricted."""
         logger.info("Checking admin access control...")
+        issues = []
+        recommendations = []
         
         # Check main.py for admin access control
-        main_file = os.path.join(self.project_dir, "main.py")
-        if os.path.exists(main_file):
-            with open(main_file, 'r') as f:
-                content = f.read()
-                
-                # Check if admin commands verify user permissions
-                if not re.search(r'(db\.is_admin|not db\.is_admin).+config\.ADMIN_USER_IDS', content):
-                    self.issues.append("Admin access control may not be properly implemented")
-                    self.recommendations.append(
-                        "Ensure all admin commands verify user permissions using both "
-                        "database admin status and the ADMIN_USER_IDS list"
-                    )
+        scan = self._scan("main.py")
+        if scan is not None:
+            # Check if admin commands verify user permissions
+            if not scan["admin_check"]:
+                issues.append("Admin access control may not be properly implemented")
+                recommendations.append(
+                    "Ensure all admin commands verify user permissions using db.is_admin"
+                )
+        
+        # Check database.py merges the ADMIN_USER_IDS list into admin status
+        scan = self._scan("database.py")
+        if scan is not None:
+            if not scan["admin_ids"]:
+                issues.append("Admin status may ignore the configured ADMIN_USER_IDS list")
+                recommendations.append(
+                    "Ensure db.is_admin covers both database admin status "
+                    "and the ADMIN_USER_IDS list"
+                )
+        
+        return issues, recommendations
     
     def check_payment_security(self):
         """Check payment handling security."""
         logger.info("Checking payment security...")
+        issues = []
+        recommendations = []
         
         # Check payment.py for secure handling
-        payment_file = os.path.join(self.project_dir, "payment.py")
-        if os.path.exists(payment_file):
-            with open(payment_file, 'r') as f:
-                content = f.read()
-                
-                # Check for pre-checkout validation
-                if "handle_pre_checkout" not in content:
-                    self.issues.append("Pre-checkout validation may be missing")
-                    self.recommendations.append(
-                        "Implement pre-checkout validation to verify payment details "
-                        "before accepting payments"
-                    )
-                
-                # Check for payment provider token security
-                if "provider_token" in content and not re.search(r'provider_token\s*=\s*config\.PAYMENT_PROVIDER_TOKEN', content):
-                    self.issues.append("Payment provider token may not be securely stored")
-                    self.recommendations.append(
-                        "Store payment provider token in config and load it from environment variables"
-                    )
+        scan = self._scan("payment.py")
+        if scan is not None:
+            # Check for pre-checkout validation
+            if not scan["pre_checkout"]:
+                issues.append("Pre-checkout validation may be missing")
+                recommendations.append(
+                    "Implement pre-checkout validation to verify payment details "
+                    "before accepting payments"
+                )
+            
+            # Check for payment provider token security
+            if scan["provider_token"] and not scan["provider_token_config"]:
+                issues.append("Payment provider token may not be securely stored")
+                recommendations.append(
+                    "Store payment provider token in config and load it from environment variables"
+                )
+        
+        return issues, recommendations
     
     def check_user_data_protection(self):
         """Check if user data is properly protected."""
         logger.info("Checking user data protection...")
+        issues = []
+        recommendations = []
         
         # Check database.py for data protection
-        database_file = os.path.join(self.project_dir, "database.py")
-        if os.path.exists(database_file):
-            with open(database_file, 'r') as f:
-                content = f.read()
-                
-                # Check if database file is protected
-                if not re.search(r'os\.path\.exists.+database_file', content):
-                    self.recommendations.append(
-                        "Add file permission checks to ensure database file is not accessible to unauthorized users"
-                    )
-                
-                # Check for data validation before storage
-                if not re.search(r'validate|validation', content, re.IGNORECASE):
-                    self.recommendations.append(
-                        "Add data validation before storing user input in the database"
-                    )
+        scan = self._scan("database.py")
+        if scan is not None:
+            # Check if database file is protected
+            if not scan["db_exists"]:
+                recommendations.append(
+                    "Add file permission checks to ensure database file is not accessible to unauthorized users"
+                )
+            
+            # Check for data validation before storage
+            if not scan["validation"]:
+                recommendations.append(
+                    "Add data validation before storing user input in the database"
+                )
+        
+        return issues, recommendations
     
     def check_error_handling(self):
         """Check if error handling is properly implemented."""
         logger.info("Checking error handling...")
+        issues = []
+        recommendations = []
         
         # Check main.py for error handling
-        main_file = os.path.join(self.project_dir, "main.py")
-        if os.path.exists(main_file):
-            with open(main_file, 'r') as f:
-                content = f.read()
-                
-                # Check for error handler
-                if "error_handler" not in content:
-                    self.issues.append("Error handling may be missing")
-                    self.recommendations.append(
-                        "Implement a global error handler to catch and log exceptions"
-                    )
-                
-                # Check for try-except blocks
-                if content.count("try:") < 3:  # Arbitrary threshold
-                    self.recommendations.append(
-                        "Add more try-except blocks to handle potential errors in critical operations"
-                    )
+        scan = self._scan("main.py")
+        if scan is not None:
+            # Check for error handler
+            if not scan["error_handler"]:
+                issues.append("Error handling may be missing")
+                recommendations.append(
+                    "Implement a global error handler to catch and log exceptions"
+                )
+            
+            # Check for try-except blocks
+            if scan["try_block"] < 3:  # Arbitrary threshold
+                recommendations.append(
+                    "Add more try-except blocks to handle potential errors in critical operations"
+                )
+        
+        return issues, recommendations
 
 def main():
     """Run security validation and print results."""
@@ -173,8 +258,11 @@ def main():
     print(f"OVERALL: {'PASSED' if results['passed'] else 'FAILED'}")
     
     # Write results to file
-    with open("/home/ubuntu/telegram_bot/security_validation.json", "w") as f:
-        json.dump(results, f, indent=4)
+    with open("/home/ubuntu/telegram_bot/security_validation.json", "wb") as f:
+        if orjson is not None:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+        else:
+            f.write(json.dumps(results, indent=2).encode())
     
     logger.info(f"Security validation {'passed' if results['passed'] else 'failed'}")
     return results